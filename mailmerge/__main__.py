@@ -3,11 +3,15 @@ Command line interface implementation.
 
 Andrew DeOrio <awdeorio@umich.edu>
 """
+import io
 import sys
 import time
 import textwrap
 from pathlib import Path
+import collections
+import concurrent.futures
 import csv
+import itertools
 import click
 from .template_message import TemplateMessage
 from .sendmail_client import SendmailClient
@@ -38,6 +42,11 @@ from . import exceptions
     type=click.IntRange(1, None),
     help="Start on message number INTEGER",
 )
+@click.option(
+    "--workers", is_flag=False, default=1,
+    type=click.IntRange(1, None),
+    help="Number of messages to send concurrently (1)",
+)
 @click.option(
     "--template", "template_path",
     default="mailmerge_template.txt",
@@ -62,7 +71,7 @@ from . import exceptions
     type=click.Choice(["colorized", "text", "raw"]),
     help="Output format (colorized).",
 )
-def main(*, sample, dry_run, limit, no_limit, resume,
+def main(*, sample, dry_run, limit, no_limit, resume, workers,
          template_path, database_path, config_path,
          output_format):
     """
@@ -91,39 +100,53 @@ def main(*, sample, dry_run, limit, no_limit, resume,
     stop = None if no_limit else resume - 1 + limit
 
     # Run
-    message_num = 1 + start
+    message_num = 1 + start  # First message not sent yet
+    sent_after_error = []    # Messages that finished sending after an error
     try:
         template_message = TemplateMessage(template_path)
         csv_database = read_csv_database(database_path)
         sendmail_client = SendmailClient(config_path, dry_run)
+        messages = (
+            (index + 1, template_message.render(row))
+            for index, row in enumerate_range(csv_database, start, stop)
+        )
 
-        for _, row in enumerate_range(csv_database, start, stop):
-            sender, recipients, message = template_message.render(row)
-            while True:
-                try:
-                    sendmail_client.sendmail(sender, recipients, message)
-                except exceptions.MailmergeRateLimitError:
-                    print_bright_white_on_cyan(
-                        ">>> rate limit exceeded, waiting ...",
-                        output_format,
-                    )
+        with sendmail_client:
+            for num, message in sendmail_concurrently(
+                sendmail_client, messages, workers, output_format,
+            ):
+                # Collect the output for a message and write it all at once
+                output = io.StringIO()
+                print_bright_white_on_cyan(
+                    f">>> message {num}",
+                    output_format,
+                    file=output,
+                )
+                print_message(message, output_format, file=output)
+                print_bright_white_on_cyan(
+                    f">>> message {num} sent",
+                    output_format,
+                    file=output,
+                )
+                sys.stdout.write(output.getvalue())
+
+                # With several workers, later messages may finish sending after
+                # an earlier message failed
+                if num == message_num:
+                    message_num += 1
                 else:
-                    break
-                time.sleep(1)
-            print_bright_white_on_cyan(
-                f">>> message {message_num}",
-                output_format,
-            )
-            print_message(message, output_format)
-            print_bright_white_on_cyan(
-                f">>> message {message_num} sent",
-                output_format,
-            )
-            message_num += 1
+                    sent_after_error.append(num)
 
     except exceptions.MailmergeError as error:
         hint_text = ""
-        if message_num > 1:
+        if sent_after_error:
+            nums = ", ".join(str(num) for num in sent_after_error)
+            hint_text = (
+                f"\nMessages sent after the error: {nums}"
+                f'\nHint: "--resume {message_num}", but don\'t send the '
+                "messages sent after the error again"
+            )
+        elif message_num > 1:
             hint_text = f'\nHint: "--resume {message_num}"'
         sys.exit(f"Error on message {message_num}\n{error}{hint_text}")
 
@@ -181,10 +204,27 @@ def check_input_files(template_path, database_path, config_path, sample):
 
 def create_sample_input_files(template_path, database_path, config_path):
     """Create sample template, database and server config."""
+    # Check all three paths first so that we don't create some of the files
+    # and then quit.  Opening with mode "x" also catches a file created since.
     for path in [template_path, database_path, config_path]:
         if path.exists():
             sys.exit(f"Error: file exists: {path}")
-    with template_path.open("w") as template_file:
+    try:
+        write_sample_input_files(template_path, database_path, config_path)
+    except FileExistsError as err:
+        sys.exit(f"Error: file exists: {err.filename}")
+    print(textwrap.dedent(f"""\
+        Created sample template email "{template_path}"
+        Created sample database "{database_path}"
+        Created sample config file "{config_path}"
+
+        Edit these files, then run mailmerge again.\
+    """))
+
+
+def write_sample_input_files(template_path, database_path, config_path):
+    """Write sample files, raising FileExistsError if a file exists."""
+    with template_path.open("x") as template_file:
         template_file.write(textwrap.dedent("""\
             TO: {{email}}
             SUBJECT: Testing mailmerge
@@ -194,13 +234,13 @@ def create_sample_input_files(template_path, database_path, config_path):
 
             Your number is {{number}}.
         """))
-    with database_path.open("w") as database_file:
+    with database_path.open("x") as database_file:
         database_file.write(textwrap.dedent("""\
             email,name,number
             myself@mydomain.com,"Myself",17
             bob@bobdomain.com,"Bob",42
         """))
-    with config_path.open("w") as config_file:
+    with config_path.open("x") as config_file:
         config_file.write(textwrap.dedent("""\
             # Mailmerge SMTP Server Config
             # https://github.com/awdeorio/mailmerge
@@ -214,6 +254,7 @@ def create_sample_input_files(template_path, database_path, config_path):
             #   security   # Security protocol: "SSL/TLS", "STARTTLS", or omit
             #   username   # Username for SSL/TLS or STARTTLS security
             #   ratelimit  # Rate limit in messages per minute, 0 for unlimited
+            #   connectionlimit  # Messages per connection, 0 for unlimited
 
             # Example: GMail
             [smtp_server]
@@ -263,13 +304,6 @@ def create_sample_input_files(template_path, database_path, config_path):
             # port = 25
             # ratelimit = 0
         """))
-    print(textwrap.dedent(f"""\
-        Created sample template email "{template_path}"
-        Created sample database "{database_path}"
-        Created sample config file "{config_path}"
-
-        Edit these files, then run mailmerge again.\
-    """))
 
 
 def detect_database_format(database_file):
@@ -328,39 +362,132 @@ def enumerate_range(iterable, start=0, stop=None):
     """
     assert start >= 0
     assert stop is None or stop >= 0
-    for i, value in enumerate(iterable):
-        if i < start:
-            continue
-        if stop is not None and i >= stop:
-            return
-        yield i, value
+    yield from itertools.islice(enumerate(iterable), start, stop)
+
+
+def sendmail_concurrently(sendmail_client, messages, workers, output_format):
+    """Send numbered messages on a pool of threads, yielding each once sent.
+
+    The messages iterable provides (number, (sender, recipients, message))
+    tuples.  Yield a (number, message) tuple for each message sent, in the
+    order given.  An error rendering or sending a message is raised after all
+    earlier messages have been yielded.  Later messages that were already
+    sending are allowed to finish, and those sent successfully are yielded
+    before the error is raised.
+    """
+    # With one worker, send on the main thread
+    if workers == 1:
+        for num, (sender, recipients, message) in messages:
+            sendmail_with_retry(
+                sendmail_client, sender, recipients, message, output_format,
+            )
+            yield num, message
+        return
+
+    yield from sendmail_thread_pool(
+        sendmail_client, messages, workers, output_format,
+    )
+
+
+def sendmail_thread_pool(sendmail_client, messages, workers, output_format):
+    """Send numbered messages on a pool of threads.
+
+    See sendmail_concurrently().
+    """
+    # Prompt for a password up front, before any worker needs it
+    sendmail_client.read_password()
+
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        try:
+            while error is None:
+                # Render the next message.  Defer a rendering error until
+                # earlier messages have finished sending.
+                try:
+                    num, (sender, recipients, message) = next(messages)
+                except StopIteration:
+                    break
+                except exceptions.MailmergeError as err:
+                    future = concurrent.futures.Future()
+                    future.set_exception(err)
+                    pending.append((None, None, future))
+                    break
+                future = executor.submit(
+                    sendmail_with_retry, sendmail_client,
+                    sender, recipients, message, output_format,
+                )
+                pending.append((num, message, future))
+
+                # Wait for the oldest message when all workers are busy
+                if len(pending) == workers:
+                    num, message, future = pending.popleft()
+                    error = future.exception()
+                    if error is None:
+                        yield num, message
+
+            # Wait for the remaining messages.  After an error, don't start
+            # any more messages, but report those that were already sending.
+            while pending:
+                num, message, future = pending.popleft()
+                if error is not None and future.cancel():
+                    continue
+                if future.exception() is None:
+                    yield num, message
+                elif error is None:
+                    error = future.exception()
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+    if error is not None:
+        raise error
+
+
+def sendmail_with_retry(sendmail_client, sender, recipients, message,
+                        output_format):
+    """Send a message, waiting and retrying while over the rate limit."""
+    # We pass through arguments from main() and sendmail_concurrently()
+    # pylint: disable=too-many-arguments
+    while True:
+        try:
+            sendmail_client.sendmail(sender, recipients, message)
+        except exceptions.MailmergeRateLimitError as err:
+            print_bright_white_on_cyan(
+                ">>> rate limit exceeded, waiting ...",
+                output_format,
+            )
+            # Wait until the rate limit allows the next message
+            time.sleep(err.waittime)
+        else:
+            break
 
 
-def print_cyan(string, output_format):
-    """Print string to stdout, optionally enabling color."""
+def print_cyan(string, output_format, file=None):
+    """Print string to file or stdout, optionally enabling color."""
     if output_format == "colorized":
         string = "\x1b[36m" + string + "\x1b(B\x1b[m"
-    print(string)
+    print(string, file=file)
 
 
-def print_bright_white_on_cyan(string, output_format):
-    """Print string to stdout, optionally enabling color."""
+def print_bright_white_on_cyan(string, output_format, file=None):
+    """Print string to file or stdout, optionally enabling color."""
     if output_format == "colorized":
         string = "\x1b[7m\x1b[1m\x1b[36m" + string + "\x1b(B\x1b[m"
-    print(string)
+    print(string, file=file)
 
 
-def print_message(message, output_format):
-    """Print a message with colorized output."""
+def print_message(message, output_format, file=None):
+    """Print a message with colorized output to file or stdout."""
     assert output_format in ["colorized", "text", "raw"]
 
     if output_format == "raw":
-        print(message)
+        print(message, file=file)
         return
 
     for header, value in message.items():
-        print(f"{header}: {value}")
-    print()
+        print(f"{header}: {value}", file=file)
+    print(file=file)
     for part in message.walk():
         if part.get_content_maintype() == "multipart":
             pass
@@ -370,19 +497,22 @@ def print_message(message, output_format):
                 print_cyan(
                     f">>> message part: {part.get_content_type()}",
                     output_format,
+                    file=file,
                 )
             charset = str(part.get_charset())
-            print(part.get_payload(decode=True).decode(charset))
-            print()
+            print(part.get_payload(decode=True).decode(charset), file=file)
+            print(file=file)
         elif is_attachment(part):
             print_cyan(
                 f">>> message part: attachment {part.get_filename()}",
                 output_format,
+                file=file,
             )
         else:
             print_cyan(
                 f">>> message part: {part.get_content_type()}",
                 output_format,
+                file=file,
             )
 
 
@@ -6,4 +6,13 @@ class MailmergeError(Exception):
 
 
 class MailmergeRateLimitError(MailmergeError):
-    """Reuse to send message because rate limit exceeded."""
+    """Reuse to send message because rate limit exceeded.
+
+    The waittime attribute is the number of seconds until the rate limit
+    allows the next message.
+    """
+
+    def __init__(self, waittime=0.0):
+        """Store the time to wait before retrying."""
+        super().__init__(f"rate limit exceeded, wait {waittime:.3f} s")
+        self.waittime = waittime
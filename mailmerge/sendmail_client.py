@@ -4,24 +4,53 @@ SMTP client reads configuration and sends message.
 Andrew DeOrio <awdeorio@umich.edu>
 """
 import collections
+import contextlib
+import functools
+import os
+import queue
 import socket
 import smtplib
 import configparser
 import getpass
-import datetime
 import base64
 import ssl
+import threading
+import time
 from . import exceptions
 
 # Type to store info read from config file
 MailmergeConfig = collections.namedtuple(
     "MailmergeConfig",
-    ["username", "host", "port", "security", "ratelimit"],
+    ["username", "host", "port", "security", "ratelimit", "connectionlimit"],
 )
 
+# SMTP reply codes for temporary errors worth retrying: service not available
+# (often throttling), mailbox busy, local error and TLS or authentication
+# temporarily unavailable
+SMTP_TEMPORARY_ERROR_CODES = {421, 450, 451, 454}
+
+# Number of times to retry a temporary error, waiting 1, 2, 4, ... seconds
+SMTP_RETRIES = 4
+
+# SendmailClient method that opens a connection for each security type
+SECURITY_CONNECT_METHODS = {
+    None: "connect_clear",
+    "SSL/TLS": "connect_ssltls",
+    "STARTTLS": "connect_starttls",
+    "PLAIN": "connect_plain",
+    "XOAUTH": "connect_xoauth",
+}
+
 
 class SendmailClient:
-    """Represent a client connection to an SMTP server."""
+    """Represent a client connection to an SMTP server.
+
+    Connections are kept open and reused for subsequent messages until close()
+    is called.
+    """
+
+    # Connections share some state, like the password and SSL context
+    # pylint: disable=too-many-instance-attributes
 
     def __init__(self, config_path, dry_run=False):
         """Read configuration from server configuration file."""
@@ -29,76 +58,87 @@ class SendmailClient:
         self.dry_run = dry_run  # Do not send real messages
         self.config = None      # Config read from config_path by read_config()
         self.password = None    # Password read from stdin
-        self.lastsent = None    # Timestamp of last successful send
+        self.lastsent = None    # Monotonic time of last send, in seconds
+        self.lock = threading.Lock()          # Protect password and lastsent
+        self.connections = queue.LifoQueue()  # Idle (SMTP, messages sent)
+        self.ssl_context = None  # Shared by SSL/TLS connections
+        self.xoauth2_token = None  # Shared by XOAUTH connections
         self.read_config()
 
     def read_config(self):
-        """Read configuration file and return a MailmergeConfig object."""
-        try:
-            parser = configparser.RawConfigParser()
-            parser.read(str(self.config_path))
-            host = parser.get("smtp_server", "host")
-            port = parser.getint("smtp_server", "port")
-            security = parser.get("smtp_server", "security", fallback=None)
-            username = parser.get("smtp_server", "username", fallback=None)
-            ratelimit = parser.getint("smtp_server", "ratelimit", fallback=0)
-        except (configparser.Error, ValueError) as err:
-            raise exceptions.MailmergeError(f"{self.config_path}: {err}")
-
-        # Coerce legacy option "security = Never"
-        if security == "Never":
-            security = None
-
-        # Verify security type
-        if security not in [None, "SSL/TLS", "STARTTLS", "PLAIN", "XOAUTH"]:
-            raise exceptions.MailmergeError(
-                f"{self.config_path}: unrecognized security type: '{security}'"
-            )
+        """Read configuration file into self.config."""
+        self.config = read_config(self.config_path)
 
-        # Verify username
-        if security is not None and username is None:
-            raise exceptions.MailmergeError(
-                f"{self.config_path}: username is required for "
-                f"security type '{security}'"
-            )
+    def __enter__(self):
+        """Return the client for use in a with statement."""
+        return self
 
-        # Save validated configuration
-        self.config = MailmergeConfig(
-            username, host, port, security, ratelimit,
-        )
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close connections at the end of a with statement."""
+        self.close()
+
+    def close(self):
+        """Close idle SMTP connections."""
+        while True:
+            try:
+                smtp, _ = self.connections.get_nowait()
+            except queue.Empty:
+                return
+            quit_connection(smtp)
+
+    def read_password(self):
+        """Ask for password if necessary.
+
+        A dry run never needs a password.  The MAILMERGE_PASSWORD environment
+        variable, if set, supplies the password without a prompt, for example
+        when running unattended.
+        """
+        if self.dry_run:
+            return
+        with self.lock:
+            if self.config.security is None or self.password is not None:
+                return
+            self.password = os.environ.get("MAILMERGE_PASSWORD")
+            if self.password is None:
+                self.password = getpass.getpass(
+                    f">>> password for {self.config.username} on "
+                    f"{self.config.host}: "
+                )
 
     def sendmail(self, sender, recipients, message):
-        """Send email message."""
+        """Send email message.
+
+        This method may be called from several threads at once.  Each thread
+        sends on its own connection.
+        """
         if self.dry_run:
             return
 
-        # Check if we've hit the rate limit
-        now = datetime.datetime.now()
-        if self.config.ratelimit and self.lastsent:
-            waittime = datetime.timedelta(minutes=1.0 / self.config.ratelimit)
-            if now - self.lastsent < waittime:
-                raise exceptions.MailmergeRateLimitError()
-
-        # Ask for password if necessary
-        if self.config.security is not None and self.password is None:
-            self.password = getpass.getpass(
-                f">>> password for {self.config.username} on "
-                f"{self.config.host}: "
-            )
+        # Check if we've hit the rate limit.  Reserve the time slot before
+        # sending so that concurrent senders wait their turn.
+        with self.lock:
+            now = time.monotonic()
+            if self.config.ratelimit and self.lastsent is not None:
+                waittime = 60.0 / self.config.ratelimit
+                if now - self.lastsent < waittime:
+                    raise exceptions.MailmergeRateLimitError(
+                        self.lastsent + waittime - now,
+                    )
+            self.lastsent = now
+
+        self.read_password()
+
+        # Flatten the message once, before any retry.  smtplib sends bytes
+        # unmodified, so generate them with the CRLF line endings SMTP needs.
+        # Don't refold headers, which the template has already laid out.
+        message_flattened = message.as_bytes(
+            policy=message.policy.clone(linesep="\r\n", max_line_length=0),
+        )
 
         # Send
         host, port = self.config.host, self.config.port
         try:
-            if self.config.security == "SSL/TLS":
-                self.sendmail_ssltls(sender, recipients, message)
-            elif self.config.security == "STARTTLS":
-                self.sendmail_starttls(sender, recipients, message)
-            elif self.config.security == "PLAIN":
-                self.sendmail_plain(sender, recipients, message)
-            elif self.config.security == "XOAUTH":
-                self.sendmail_xoauth(sender, recipients, message)
-            elif self.config.security is None:
-                self.sendmail_clear(sender, recipients, message)
+            self.sendmail_retry(sender, recipients, message_flattened)
         except smtplib.SMTPAuthenticationError as err:
             raise exceptions.MailmergeError(
                 f"{host}:{port} failed to authenticate "
@@ -113,62 +153,211 @@ class SendmailClient:
                 f"{host}:{port} failed to connect to server: {err}"
             )
 
-        # Update timestamp of last sent message
-        self.lastsent = now
+    def sendmail_retry(self, sender, recipients, message_flattened):
+        """Send a flattened message, retrying after temporary failures.
+
+        The server may have closed an idle connection, so retry once right away
+        on a new connection.  The server may also reply with a temporary error,
+        for example 421 when it is throttling clients, so retry with
+        exponential backoff.
+        """
+        for attempt in range(SMTP_RETRIES + 1):
+            try:
+                try:
+                    self.sendmail_flattened(
+                        sender, recipients, message_flattened,
+                    )
+                except smtplib.SMTPServerDisconnected:
+                    self.sendmail_flattened(
+                        sender, recipients, message_flattened, reuse=False,
+                    )
+                return
+            except smtplib.SMTPResponseException as err:
+                if err.smtp_code not in SMTP_TEMPORARY_ERROR_CODES:
+                    raise
+                if attempt == SMTP_RETRIES:
+                    raise
+            time.sleep(2 ** attempt)
 
-    def sendmail_ssltls(self, sender, recipients, message):
-        """Send email message with SSL/TLS security."""
-        message_flattened = str(message)
+    def sendmail_flattened(self, sender, recipients, message_flattened,
+                           reuse=True):
+        """Send a flattened message on an idle or new connection.
+
+        The connection is kept open for the next message on success and closed
+        on error.  It is also closed once it has sent connectionlimit messages,
+        because some servers limit the number of messages per connection.
+        """
+        smtp, nsent = None, 0
+        if reuse:
+            try:
+                smtp, nsent = self.connections.get_nowait()
+            except queue.Empty:
+                pass
+        if smtp is None:
+            smtp = self.connect()
         try:
-            ctx = ssl.create_default_context()
-        except ssl.SSLError as err:
-            raise exceptions.MailmergeError(f"SSL Error: {err}")
-        host, port = (self.config.host, self.config.port)
-        with smtplib.SMTP_SSL(host, port, context=ctx) as smtp:
-            smtp.login(self.config.username, self.password)
             smtp.sendmail(sender, recipients, message_flattened)
+        except (smtplib.SMTPException, socket.error):
+            smtp.close()
+            raise
+        nsent += 1
+        if self.config.connectionlimit and \
+                nsent >= self.config.connectionlimit:
+            quit_connection(smtp)
+        else:
+            self.connections.put((smtp, nsent))
 
-    def sendmail_starttls(self, sender, recipients, message):
-        """Send email message with STARTTLS security."""
-        message_flattened = str(message)
-        with smtplib.SMTP(self.config.host, self.config.port) as smtp:
-            smtp.ehlo()
-            smtp.starttls()
-            smtp.ehlo()
-            smtp.login(self.config.username, self.password)
-            smtp.sendmail(sender, recipients, message_flattened)
+    def connect(self):
+        """Open a new SMTP connection and log in."""
+        connect_security = getattr(
+            self, SECURITY_CONNECT_METHODS[self.config.security],
+        )
+        with contextlib.ExitStack() as stack:
+            smtp = connect_security(stack)
 
-    def sendmail_plain(self, sender, recipients, message):
-        """Send email message with plain security."""
-        message_flattened = str(message)
-        with smtplib.SMTP(self.config.host, self.config.port) as smtp:
-            smtp.login(self.config.username, self.password)
-            smtp.sendmail(sender, recipients, message_flattened)
+            # Keep the connection open after a successful login
+            stack.pop_all()
+        return smtp
 
-    def sendmail_clear(self, sender, recipients, message):
-        """Send email message with no security."""
-        message_flattened = str(message)
-        with smtplib.SMTP(self.config.host, self.config.port) as smtp:
-            smtp.sendmail(sender, recipients, message_flattened)
+    def connect_ssltls(self, stack):
+        """Open a connection with SSL/TLS security.
 
-    def sendmail_xoauth(self, sender, recipients, message):
-        """Send email message with XOAUTH security."""
-        xoauth2 = (
-            f"user={self.config.username}\x01"
-            f"auth=Bearer {self.password}\x01\x01"
+        The SSL context loads the system's CA certificates, so it is created
+        once and reused for later connections.
+        """
+        if self.ssl_context is None:
+            try:
+                self.ssl_context = ssl.create_default_context()
+            except ssl.SSLError as err:
+                raise exceptions.MailmergeError(f"SSL Error: {err}")
+        host, port = (self.config.host, self.config.port)
+        smtp = stack.enter_context(
+            smtplib.SMTP_SSL(host, port, context=self.ssl_context)
         )
-        try:
-            xoauth2 = xoauth2.encode("ascii")
-        except UnicodeEncodeError as err:
-            raise exceptions.MailmergeError(
-                f"Username and XOAUTH access token must be ASCII '{xoauth2}'. "
-                f"{err}, "
+        smtp.login(self.config.username, self.password)
+        return smtp
+
+    def connect_starttls(self, stack):
+        """Open a connection with STARTTLS security."""
+        smtp = stack.enter_context(
+            smtplib.SMTP(self.config.host, self.config.port)
+        )
+        smtp.ehlo()
+        smtp.starttls()
+        smtp.ehlo()
+        smtp.login(self.config.username, self.password)
+        return smtp
+
+    def connect_plain(self, stack):
+        """Open a connection with plain security."""
+        smtp = stack.enter_context(
+            smtplib.SMTP(self.config.host, self.config.port)
+        )
+        smtp.login(self.config.username, self.password)
+        return smtp
+
+    def connect_clear(self, stack):
+        """Open a connection with no security."""
+        return stack.enter_context(
+            smtplib.SMTP(self.config.host, self.config.port)
+        )
+
+    def connect_xoauth(self, stack):
+        """Open a connection with XOAUTH security.
+
+        The base64 encoded authentication string is built once and reused for
+        later connections.
+        """
+        if self.xoauth2_token is None:
+            xoauth2 = (
+                f"user={self.config.username}\x01"
+                f"auth=Bearer {self.password}\x01\x01"
             )
-        message_flattened = str(message)
-        with smtplib.SMTP(self.config.host, self.config.port) as smtp:
-            smtp.ehlo()
-            smtp.starttls()
-            smtp.ehlo()
-            smtp.docmd('AUTH XOAUTH2')
-            smtp.docmd(str(base64.b64encode(xoauth2).decode("utf-8")))
-            smtp.sendmail(sender, recipients, message_flattened)
+            try:
+                xoauth2 = xoauth2.encode("ascii")
+            except UnicodeEncodeError as err:
+                raise exceptions.MailmergeError(
+                    "Username and XOAUTH access token must be ASCII "
+                    f"'{xoauth2}'. {err}, "
+                )
+            self.xoauth2_token = base64.b64encode(xoauth2).decode("ascii")
+        smtp = stack.enter_context(
+            smtplib.SMTP(self.config.host, self.config.port)
+        )
+        smtp.ehlo()
+        smtp.starttls()
+        smtp.ehlo()
+        smtp.docmd('AUTH XOAUTH2')
+        smtp.docmd(self.xoauth2_token)
+        return smtp
+
+
+def quit_connection(smtp):
+    """Close an SMTP connection politely, or abruptly if that fails."""
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, socket.error):
+        smtp.close()
+
+
+def read_config(config_path):
+    """Read configuration file and return a MailmergeConfig object.
+
+    Configs are cached, so a config file is only parsed again after it is
+    modified.
+    """
+    try:
+        stat = os.stat(config_path)
+    except OSError:
+        cache_key = None  # Parsing will report the error
+    else:
+        cache_key = (
+            os.path.abspath(config_path), stat.st_mtime_ns, stat.st_size,
+        )
+    return parse_config(config_path, cache_key)
+
+
+@functools.lru_cache(maxsize=16)
+def parse_config(config_path, cache_key):
+    """Parse and validate configuration file.
+
+    Use read_config() instead.  The cache_key argument identifies the file
+    contents for the cache and is otherwise unused.  Errors refer to the file
+    by config_path, as given by the user.
+    """
+    # cache_key is only used by the lru_cache decorator
+    # pylint: disable=unused-argument
+    try:
+        parser = configparser.RawConfigParser()
+        parser.read(str(config_path))
+        host = parser.get("smtp_server", "host")
+        port = parser.getint("smtp_server", "port")
+        security = parser.get("smtp_server", "security", fallback=None)
+        username = parser.get("smtp_server", "username", fallback=None)
+        ratelimit = parser.getint("smtp_server", "ratelimit", fallback=0)
+        connectionlimit = parser.getint(
+            "smtp_server", "connectionlimit", fallback=0,
+        )
+    except (configparser.Error, ValueError) as err:
+        raise exceptions.MailmergeError(f"{config_path}: {err}")
+
+    # Coerce legacy option "security = Never"
+    if security == "Never":
+        security = None
+
+    # Verify security type
+    if security not in SECURITY_CONNECT_METHODS:
+        raise exceptions.MailmergeError(
+            f"{config_path}: unrecognized security type: '{security}'"
+        )
+
+    # Verify username
+    if security is not None and username is None:
+        raise exceptions.MailmergeError(
+            f"{config_path}: username is required for "
+            f"security type '{security}'"
+        )
+
+    return MailmergeConfig(
+        username, host, port, security, ratelimit, connectionlimit,
+    )
@@ -4,19 +4,23 @@ Represent a templated email message.
 Andrew DeOrio <awdeorio@umich.edu>
 """
 
-import re
+import base64
+import functools
+import time
 from pathlib import Path
 from xml.etree import ElementTree
 import email
+import email.encoders
 import email.mime
 import email.mime.application
 import email.mime.multipart
 import email.mime.text
-import html5lib
-import markdown
 import jinja2
 from . import exceptions
 
+# Size of attachment file chunks to base64 encode at a time
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
 
 class TemplateMessage:
     """Represent a templated email message.
@@ -29,6 +33,9 @@ class TemplateMessage:
     # more than one public method.
     # pylint: disable=too-few-public-methods
 
+    # Each instance caches a few objects reused for every message it renders
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self, template_path):
         """Initialize variables and Jinja2 template."""
         self.template_path = Path(template_path)
@@ -36,12 +43,16 @@ class TemplateMessage:
         self._sender = None
         self._recipients = None
         self._attachment_content_ids = {}
+        self._markdown = None
+        self._attachments = {}  # Header index: (path, mtime, size, base64)
+
+        # Relative attachment paths are relative to the template's parent dir.
+        # Resolve it once so that cached attachment paths don't depend on the
+        # current working directory.
+        self._template_dir = self.template_path.parent.resolve()
 
         # Configure Jinja2 template engine with the template dirname as root.
-        template_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(template_path.parent),
-            undefined=jinja2.StrictUndefined,
-        )
+        template_env = get_template_environment(self._template_dir)
         self.template = template_env.get_template(
             template_path.parts[-1],  # basename
         )
@@ -53,12 +64,13 @@ class TemplateMessage:
         except jinja2.exceptions.TemplateError as err:
             raise exceptions.MailmergeError(f"{self.template_path}: {err}")
         self._message = email.message_from_string(raw_message)
+        self._attachment_content_ids = {}
         self._transform_encoding(raw_message)
         self._transform_recipients()
         self._transform_markdown()
         self._transform_attachments()
         self._transform_attachment_references()
-        self._message.add_header('Date', email.utils.formatdate())
+        self._message.add_header('Date', format_date(int(time.time())))
         assert self._sender
         assert self._recipients
         assert self._message
@@ -67,6 +79,12 @@ class TemplateMessage:
     def _transform_encoding(self, raw_message):
         """Detect and set character encoding."""
         encoding = "us-ascii" if is_ascii(raw_message) else "utf-8"
+
+        # Most templates are a single text part, which needs no walk
+        if not self._message.is_multipart():
+            self._message.set_charset(encoding)
+            return
+
         for part in self._message.walk():
             if part.get_content_maintype() == 'multipart':
                 continue
@@ -102,13 +120,11 @@ class TemplateMessage:
         # Copy headers.  Avoid duplicate Content-Type and MIME-Version headers,
         # which we set explicitely.  MIME-Version was set when we created an
         # empty mulitpart message.  Content-Type will be set when we copy the
-        # original text later.
-        for header_key in set(self._message.keys()):
+        # original text later.  Copy in one pass to preserve header order.
+        for header_key, value in self._message.items():
             if header_key.lower() in ["content-type", "mime-version"]:
                 continue
-            values = self._message.get_all(header_key, failobj=[])
-            for value in values:
-                multipart_message[header_key] = value
+            multipart_message[header_key] = value
 
         # Copy text, preserving original encoding
         original_text = self._message.get_payload(decode=True)
@@ -139,7 +155,7 @@ class TemplateMessage:
         top-level `multipart/related` message.
         """
         # Do nothing if Content-Type is not text/markdown
-        if not self._message['Content-Type'].startswith("text/markdown"):
+        if self._message.get_content_type() != "text/markdown":
             return
 
         # Remove the markdown Content-Type header, it's non-standard for email
@@ -152,7 +168,7 @@ class TemplateMessage:
         # Extract unrendered text and encoding.  We assume that the first
         # plaintext payload is formatted with Markdown.
         for mimetext in self._message.get_payload():
-            if mimetext['Content-Type'].startswith('text/plain'):
+            if mimetext.get_content_type() == 'text/plain':
                 original_text_payload = mimetext
                 encoding = str(mimetext.get_charset())
                 text = mimetext.get_payload(decode=True).decode(encoding)
@@ -171,7 +187,7 @@ class TemplateMessage:
         # multipart/alternative message as per RFC 2046.
         #
         # https://docs.python.org/3/library/email.mime.html#email.mime.text.MIMEText
-        html = markdown.markdown(text, extensions=['nl2br'])
+        html = self._get_markdown().reset().convert(text)
         html_payload = email.mime.text.MIMEText(
             f"<html><body>{html}</body></html>",
             _subtype="html",
@@ -184,6 +200,19 @@ class TemplateMessage:
 
         self._message.attach(message_payload)
 
+    def _get_markdown(self):
+        """Return a Markdown converter, creating it on first use.
+
+        The converter is reused for every message because loading extensions
+        is expensive.  Call reset() before converting a new document.
+        """
+        if self._markdown is None:
+            # Import markdown on first use, it's slow to import and only
+            # needed for markdown templates
+            import markdown  # pylint: disable=import-outside-toplevel
+            self._markdown = markdown.Markdown(extensions=['nl2br'])
+        return self._markdown
+
     def _transform_attachments(self):
         """
         Parse attachment headers and generate content-id headers for each.
@@ -212,20 +241,39 @@ class TemplateMessage:
         if 'attachment' not in self._message:
             return
 
+        # Find attachment files before changing the message structure.  Remove
+        # the attachment header, it's non-standard for email.
+        paths = [
+            self._resolve_attachment_path(path)
+            for path in self._message.get_all('attachment')
+        ]
+        del self._message['attachment']
+
         # Make sure the message is multipart.  We need a multipart message in
         # order to add an attachment.
         self._make_message_multipart()
 
         # Add each attachment to the message
-        for path in self._message.get_all('attachment', failobj=[]):
-            path = self._resolve_attachment_path(path)
-            with path.open("rb") as attachment:
-                content = attachment.read()
+        for index, path in enumerate(paths):
             basename = path.parts[-1]
+
+            # Resolved paths are cached, so the file may have been removed
+            # since it was found.
+            try:
+                content = self._read_attachment_base64(index, path)
+            except FileNotFoundError as err:
+                raise exceptions.MailmergeError(
+                    f"Attachment not found: {path}"
+                ) from err
+
+            # The payload is already encoded, so skip the default encoder and
+            # set the header ourselves.
             part = email.mime.application.MIMEApplication(
                 content,
+                _encoder=email.encoders.encode_noop,
                 Name=str(basename),
             )
+            part['Content-Transfer-Encoding'] = 'base64'
             part.add_header(
                 'Content-Disposition',
                 f'attachment; filename="{basename}"'
@@ -240,9 +288,6 @@ class TemplateMessage:
 
             self._message.attach(part)
 
-        # Remove the attachment header, it's non-standard for email
-        del self._message['attachment']
-
     def _transform_attachment_references(self):
         """
         Replace references to inline-images in the email body's HTML content.
@@ -250,21 +295,33 @@ class TemplateMessage:
         Specifically, match inline-image src attributes with content-ids from
         image attachments, if available.
         """
-        if not self._message.is_multipart():
+        # Parsing HTML is expensive.  Skip it when there are no attachments to
+        # reference.
+        if not self._attachment_content_ids:
             return
 
+        # Import html5lib on first use, it's slow to import and only needed
+        # for messages with attachments
+        import html5lib  # pylint: disable=import-outside-toplevel
+
         for part in self._message.walk():
-            if not part['Content-Type'].startswith('text/html'):
+            if part.get_content_type() != 'text/html':
                 continue
 
+            # Skip parsing HTML without images
             html = part.get_payload(decode=True).decode('utf-8')
+            if "<img" not in html.lower():
+                continue
+
             document = html5lib.parse(html, namespaceHTMLElements=False)
             images = document.findall('.//img')
-            if len(images) == 0:
+            if not images:
                 continue
 
-            for img in document.findall('.//img'):
+            for img in images:
                 src = img.get('src')
+                if src is None:
+                    continue
                 try:
                     src = str(self._resolve_attachment_path(src))
                 except exceptions.MailmergeError:
@@ -272,10 +329,9 @@ class TemplateMessage:
                     # have been attached to the email.
                     continue
 
-                if src in self._attachment_content_ids:
-                    cid = self._attachment_content_ids[src]
-                    url = f"cid:{cid}"
-                    img.set('src', url)
+                cid = self._attachment_content_ids.get(src)
+                if cid is not None:
+                    img.set('src', f"cid:{cid}")
                     # Only clear the header if we are transforming an
                     # attachment reference. See comment below for context.
                     del part['Content-Transfer-Encoding']
@@ -297,35 +353,98 @@ class TemplateMessage:
                 new_html = ElementTree.tostring(document).decode('utf-8')
                 part.set_payload(new_html)
 
+    def _read_attachment_base64(self, index, path):
+        """Return the base64 encoded content of an attachment.
+
+        Reuse the content of an attachment shared by several messages.  Only
+        the last file for each attachment header, identified by its index, is
+        kept.  That way, attachments that change with every message aren't
+        kept in memory.  The modification time and size identify a modified
+        file, which is read again.
+        """
+        stat = path.stat()
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        cached = self._attachments.get(index)
+        if cached is None or cached[:3] != key:
+            # Release the previous content before reading the new file
+            self._attachments.pop(index, None)
+            cached = (*key, read_attachment_base64(path))
+            self._attachments[index] = cached
+        return cached[3]
+
     def _resolve_attachment_path(self, path):
         """Find attachment file or raise MailmergeError."""
-        # Error on empty path
-        if not path.strip():
-            raise exceptions.MailmergeError("Empty attachment header.")
+        return resolve_attachment_path(self._template_dir, path)
 
-        # Create a Path object and handle home directory (tilde ~) notation
-        path = Path(path.strip())
-        path = path.expanduser()
 
-        # Relative paths are relative to the template's parent dir
-        if not path.is_absolute():
-            path = self.template_path.parent/path
+def is_ascii(string):
+    """Return True is string contains only is us-ascii encoded characters."""
+    return string.isascii()
 
-        # Resolve any symlinks
-        path = path.resolve()
 
-        # Check that the attachment exists
-        if not path.exists():
-            raise exceptions.MailmergeError(f"Attachment not found: {path}")
+@functools.lru_cache(maxsize=16)
+def get_template_environment(template_dir):
+    """Return a Jinja2 environment with template_dir as root.
 
-        return path
+    Environments are shared so that a template is only compiled once per
+    process.
+    """
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_dir),
+        undefined=jinja2.StrictUndefined,
+    )
 
 
-def is_ascii(string):
-    """Return True is string contains only is us-ascii encoded characters."""
-    def is_ascii_char(char):
-        return 0 <= ord(char) <= 127
-    return all(is_ascii_char(char) for char in string)
+@functools.lru_cache(maxsize=256)
+def resolve_attachment_path(template_dir, path):
+    """Find attachment file relative to template_dir or raise MailmergeError.
+
+    Results are cached because the same attachment paths are usually resolved
+    for every message.
+    """
+    # Error on empty path
+    if not path.strip():
+        raise exceptions.MailmergeError("Empty attachment header.")
+
+    # Create a Path object and handle home directory (tilde ~) notation
+    path = Path(path.strip())
+    path = path.expanduser()
+
+    # Relative paths are relative to the template's parent dir
+    if not path.is_absolute():
+        path = template_dir/path
+
+    # Resolve any symlinks
+    path = path.resolve()
+
+    # Check that the attachment exists
+    if not path.exists():
+        raise exceptions.MailmergeError(f"Attachment not found: {path}")
+
+    return path
+
+
+def read_attachment_base64(path):
+    """Return the base64 encoded content of an attachment file."""
+    # Encode one chunk at a time so that the whole file is never in memory
+    # alongside its encoding.  The chunk size is a multiple of 57 bytes, which
+    # encodebytes() encodes as one full 76 character line.
+    chunks = []
+    with path.open("rb") as attachment:
+        read_chunk = functools.partial(attachment.read, ATTACHMENT_CHUNK_SIZE)
+        for chunk in iter(read_chunk, b""):
+            chunks.append(base64.encodebytes(chunk).decode("ascii"))
+    return "".join(chunks)
+
+
+@functools.lru_cache(maxsize=1)
+def format_date(timeval):
+    """Return a Date header value for timeval, in seconds since the epoch.
+
+    The header has a resolution of one second, so the result is cached and
+    reused for all the messages rendered within the same second.
+    """
+    return email.utils.formatdate(timeval)
 
 
 def make_attachment_content_id():
@@ -338,6 +457,7 @@ def make_attachment_content_id():
     # reserved, see: https://en.wikipedia.org/wiki/.invalid
     cid_header = email.utils.make_msgid(domain="mailmerge.invalid")
     # The cid_header is of format `<cid>`. We need to extract the cid for
-    # later lookup.
-    cid = re.search('<(.*)>', cid_header).group(1)
+    # later lookup.  make_msgid() always adds the angle brackets, so slice them
+    # off rather than searching with a regular expression.
+    cid = cid_header[1:-1]
     return cid, cid_header
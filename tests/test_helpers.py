@@ -76,6 +76,16 @@ def test_enumerate_range_start_stop():
     assert output == [(1, "b")]
 
 
+def test_enumerate_range_stop_lazy():
+    """Verify items after stop are not read."""
+    def items():
+        yield "a"
+        yield "b"
+        raise AssertionError("read past stop")
+    output = list(enumerate_range(items(), stop=2))
+    assert output == [(0, "a"), (1, "b")]
+
+
 def test_csv_bad(tmpdir):
     """CSV with unmatched quote."""
     database_path = Path(tmpdir/"database.csv")
@@ -4,11 +4,11 @@ Tests for SMTP server rate limit feature.
 Andrew DeOrio <awdeorio@umich.edu>
 """
 import textwrap
+import time
 import datetime
 from pathlib import Path
 import email
 import email.parser
-import freezegun
 import pytest
 import click.testing
 from mailmerge import SendmailClient, MailmergeRateLimitError
@@ -49,26 +49,25 @@ def test_sendmail_ratelimit(mocker, tmp_path):
     assert smtp.sendmail.call_count == 1
 
     # Second message exceeds the rate limit, doesn't try to send a message
-    with pytest.raises(MailmergeRateLimitError):
+    with pytest.raises(MailmergeRateLimitError) as excinfo:
         sendmail_client.sendmail(
             sender="from@test.com",
             recipients=["to@test.com"],
             message=message,
         )
     assert smtp.sendmail.call_count == 1
+    assert 0 < excinfo.value.waittime <= 1
 
     # Retry the second message after 1 s because the rate limit is 60 messages
     # per minute
     #
-    # Mock the time to be 1.1 s in the future
-    # Ref: https://github.com/spulec/freezegun
-    now = datetime.datetime.now()
-    with freezegun.freeze_time(now + datetime.timedelta(seconds=1)):
-        sendmail_client.sendmail(
-            sender="from@test.com",
-            recipients=["to@test.com"],
-            message=message,
-        )
+    # Mock the monotonic clock to be 1 s in the future
+    mocker.patch("time.monotonic", return_value=time.monotonic() + 1)
+    sendmail_client.sendmail(
+        sender="from@test.com",
+        recipients=["to@test.com"],
+        message=message,
+    )
     assert smtp.sendmail.call_count == 2
 
 
@@ -123,3 +122,51 @@ def test_stdout_ratelimit(mocker, tmpdir):
     assert ">>> message 1 sent" in result.stdout
     assert ">>> rate limit exceeded, waiting ..." in result.stdout
     assert ">>> message 2 sent" in result.stdout
+
+
+def test_stdout_ratelimit_wait(mocker, tmpdir):
+    """Verify mailmerge waits for the rate limit, not a fixed time."""
+    template_path = Path(tmpdir/"mailmerge_template.txt")
+    template_path.write_text(textwrap.dedent("""\
+        TO: {{email}}
+        FROM: from@test.com
+
+        Hello world
+    """), encoding="utf8")
+    database_path = Path(tmpdir/"mailmerge_database.csv")
+    database_path.write_text(textwrap.dedent("""\
+        email
+        one@test.com
+        two@test.com
+    """), encoding="utf8")
+
+    # Rate limit of one message every 0.2 s
+    config_path = Path(tmpdir/"mailmerge_server.conf")
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+        ratelimit = 300
+    """), encoding="utf8")
+
+    # Run mailmerge with mock SMTP.  Spy on sleep, which still waits so that
+    # the retry is within the rate limit.
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    mock_sleep = mocker.patch('time.sleep', wraps=time.sleep)
+    with tmpdir.as_cwd():
+        runner = click.testing.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            main, [
+                "--no-limit",
+                "--no-dry-run",
+                "--output-format", "text",
+            ]
+        )
+    assert result.exit_code == 0
+    assert ">>> rate limit exceeded, waiting ..." in result.stdout
+    smtp = mock_smtp.return_value.__enter__.return_value
+    assert smtp.sendmail.call_count == 2
+
+    # Waited once, for the rest of the 0.2 s interval
+    assert mock_sleep.call_count == 1
+    assert 0 < mock_sleep.call_args.args[0] <= 0.2
@@ -145,6 +145,31 @@ def test_security_error(tmp_path):
         SendmailClient(config_path, dry_run=False)
 
 
+def test_password_environment(mocker, tmp_path):
+    """Verify the password is read from MAILMERGE_PASSWORD without a prompt."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = smtp.test.com
+        port = 465
+        security = SSL/TLS
+        username = YOUR_USERNAME_HERE
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+    mocker.patch.dict("os.environ", {"MAILMERGE_PASSWORD": "password"})
+    mock_getpass = mocker.patch('getpass.getpass')
+    mock_smtp_ssl = mocker.patch('smtplib.SMTP_SSL')
+    sendmail_client.sendmail(
+        sender="test@test.com",
+        recipients=["test@test.com"],
+        message=message,
+    )
+    assert mock_getpass.call_count == 0
+    smtp = mock_smtp_ssl.return_value.__enter__.return_value
+    smtp.login.assert_called_once_with("YOUR_USERNAME_HERE", "password")
+
+
 def test_security_open(mocker, tmp_path):
     """Verify open (Never) security configuration."""
     # Config for no security SMTP server
@@ -336,6 +361,39 @@ def test_security_xoauth_bad_username(mocker, tmp_path):
     assert "Username and XOAUTH access token must be ASCII" in str(err.value)
 
 
+def test_security_xoauth_reconnect(mocker, tmp_path):
+    """Verify a new XOAUTH connection authenticates with the same token."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = smtp.office365.com
+        port = 587
+        security = XOAUTH
+        username = username@example.com
+        connectionlimit = 1
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    mocker.patch('getpass.getpass', return_value="password")
+    mock_b64encode = mocker.patch('base64.b64encode', wraps=base64.b64encode)
+
+    # Send two messages, each on a new connection
+    for _ in range(2):
+        sendmail_client.sendmail(
+            sender="test@test.com",
+            recipients=["test@test.com"],
+            message=message,
+        )
+    assert mock_smtp.call_count == 2
+    assert mock_b64encode.call_count == 1
+    smtp = mock_smtp.return_value.__enter__.return_value
+    tokens = [call.args[0] for call in smtp.docmd.call_args_list[1::2]]
+    assert base64.b64decode(tokens[0]) == \
+        b'user=username@example.com\x01auth=Bearer password\x01\x01'
+    assert tokens[0] == tokens[1]
+
+
 def test_security_plain(mocker, tmp_path):
     """Verify plain security configuration."""
     # Config for Plain SMTP server
@@ -426,6 +484,35 @@ def test_security_ssl(mocker, tmp_path):
     assert smtp.sendmail.call_count == 1
 
 
+def test_ssl_context_reused(mocker, tmp_path):
+    """Verify SSL/TLS connections share one SSL context."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = smtp.mail.umich.edu
+        port = 465
+        security = SSL/TLS
+        username = YOUR_USERNAME_HERE
+        connectionlimit = 1
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+    mock_smtp_ssl = mocker.patch('smtplib.SMTP_SSL')
+    mock_ssl_create_default_context = \
+        mocker.patch('ssl.create_default_context')
+    mocker.patch('getpass.getpass', return_value="password")
+
+    # Send two messages, each on a new connection
+    for _ in range(2):
+        sendmail_client.sendmail(
+            sender="test@test.com",
+            recipients=["test@test.com"],
+            message=message,
+        )
+    assert mock_smtp_ssl.call_count == 2
+    assert mock_ssl_create_default_context.call_count == 1
+
+
 def test_ssl_error(mocker, tmp_path):
     """Verify SSL/TLS with an SSL error."""
     # Config for SSL SMTP server
@@ -609,3 +696,233 @@ def test_socket_error(mocker, tmp_path):
 
     # Verify exception string
     assert "Dummy error message" in str(err.value)
+
+
+def test_connection_reuse(mocker, tmp_path):
+    """Verify one SMTP connection is reused for several messages."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+
+    # Send two messages with mock SMTP
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    with sendmail_client:
+        for _ in range(2):
+            sendmail_client.sendmail(
+                sender="test@test.com",
+                recipients=["test@test.com"],
+                message=message,
+            )
+
+    # Verify one connection sent both messages and was closed at the end
+    assert mock_smtp.call_count == 1
+    smtp = mock_smtp.return_value.__enter__.return_value
+    assert smtp.sendmail.call_count == 2
+    assert smtp.quit.call_count == 1
+
+
+def test_connection_limit(mocker, tmp_path):
+    """Verify a connection is replaced after connectionlimit messages."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+        connectionlimit = 2
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+
+    # Send three messages with mock SMTP
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    smtp = mock_smtp.return_value.__enter__.return_value
+    with sendmail_client:
+        for _ in range(2):
+            sendmail_client.sendmail(
+                sender="test@test.com",
+                recipients=["test@test.com"],
+                message=message,
+            )
+
+        # The first connection was closed after two messages
+        assert mock_smtp.call_count == 1
+        assert smtp.quit.call_count == 1
+
+        sendmail_client.sendmail(
+            sender="test@test.com",
+            recipients=["test@test.com"],
+            message=message,
+        )
+
+    # A second connection sent the third message
+    assert mock_smtp.call_count == 2
+    assert smtp.sendmail.call_count == 3
+    assert smtp.quit.call_count == 2
+
+
+def test_reconnect(mocker, tmp_path):
+    """Verify a new connection is opened after the server disconnects."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+
+    # Configure SMTP sendmail() to fail once, as if an idle connection had
+    # been closed by the server
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    smtp = mock_smtp.return_value.__enter__.return_value
+    smtp.sendmail = mocker.Mock(
+        side_effect=[smtplib.SMTPServerDisconnected("Dummy error"), {}]
+    )
+
+    # Send a message
+    sendmail_client.sendmail(
+        sender="test@test.com",
+        recipients=["test@test.com"],
+        message=message,
+    )
+
+    # Verify the dead connection was closed and the message was resent
+    assert mock_smtp.call_count == 2
+    assert smtp.close.call_count == 1
+    assert smtp.sendmail.call_count == 2
+
+
+def test_message_flattened(mocker, tmp_path):
+    """Verify the message is sent as bytes with CRLF line endings.
+
+    Long headers are sent as they are, not refolded.
+    """
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    subject = " ".join(["Testing mailmerge"] * 5)
+    message = email.message_from_string(textwrap.dedent(f"""\
+        TO: to@test.com
+        SUBJECT: {subject}
+        FROM: from@test.com
+
+        Hello
+        world
+    """))
+
+    # Send a message with mock SMTP
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    sendmail_client.sendmail(
+        sender="from@test.com",
+        recipients=["to@test.com"],
+        message=message,
+    )
+
+    # Verify flattened message
+    smtp = mock_smtp.return_value.__enter__.return_value
+    message_flattened = smtp.sendmail.call_args.args[2]
+    assert message_flattened == (
+        b"TO: to@test.com\r\n"
+        b"SUBJECT: " + subject.encode() + b"\r\n"
+        b"FROM: from@test.com\r\n"
+        b"\r\n"
+        b"Hello\r\n"
+        b"world\r\n"
+    )
+
+
+def test_temporary_error_retry(mocker, tmp_path):
+    """Verify a temporary SMTP error is retried after waiting."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+
+    # Configure SMTP sendmail() to fail once with a temporary error
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    mock_sleep = mocker.patch('time.sleep')
+    smtp = mock_smtp.return_value.__enter__.return_value
+    smtp.sendmail = mocker.Mock(side_effect=[
+        smtplib.SMTPSenderRefused(421, b"Too many messages", "test@test.com"),
+        {},
+    ])
+
+    # Send a message
+    sendmail_client.sendmail(
+        sender="test@test.com",
+        recipients=["test@test.com"],
+        message=message,
+    )
+
+    # Verify the message was resent after waiting
+    assert smtp.sendmail.call_count == 2
+    assert mock_sleep.call_count == 1
+
+
+def test_permanent_error_no_retry(mocker, tmp_path):
+    """Verify a permanent SMTP error is not retried."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """))
+    sendmail_client = SendmailClient(config_path, dry_run=False)
+    message = email.message_from_string("Hello world")
+
+    # Configure SMTP sendmail() to fail with a permanent error
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    mock_sleep = mocker.patch('time.sleep')
+    smtp = mock_smtp.return_value.__enter__.return_value
+    smtp.sendmail = mocker.Mock(side_effect=smtplib.SMTPSenderRefused(
+        550, b"Sender rejected", "test@test.com",
+    ))
+
+    # Send a message
+    with pytest.raises(MailmergeError) as err:
+        sendmail_client.sendmail(
+            sender="test@test.com",
+            recipients=["test@test.com"],
+            message=message,
+        )
+
+    # Verify exception string and no retries
+    assert "Sender rejected" in str(err.value)
+    assert smtp.sendmail.call_count == 1
+    assert mock_sleep.call_count == 0
+
+
+def test_config_cached(tmp_path):
+    """Verify config is parsed once and parsed again after it changes."""
+    config_path = tmp_path/"server.conf"
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """))
+    client1 = SendmailClient(config_path)
+    client2 = SendmailClient(config_path)
+    assert client1.config is client2.config
+
+    # Modify config file
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = smtp.example.com
+        port = 1025
+    """))
+    client3 = SendmailClient(config_path)
+    assert client3.config.host == "smtp.example.com"
+    assert client3.config.port == 1025
@@ -3,6 +3,7 @@ Tests for TemplateMessage.
 
 Andrew DeOrio <awdeorio@umich.edu>
 """
+# pylint: disable=too-many-lines
 import os
 import re
 import shutil
@@ -12,6 +13,7 @@ from pathlib import Path
 import pytest
 import markdown
 import html5lib
+import mailmerge.template_message
 from mailmerge import TemplateMessage, MailmergeError
 from . import utils
 
@@ -36,6 +38,33 @@ def test_simple(tmp_path):
     assert "Hello world!" in plaintext
 
 
+def test_template_reused(tmp_path):
+    """Verify a template is compiled once for several TemplateMessages."""
+    template_path = tmp_path / "template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        FROM: from@test.com
+
+        Hello world
+    """), encoding="utf8")
+    template_message1 = TemplateMessage(template_path)
+    template_message2 = TemplateMessage(template_path)
+    assert template_message1.template is template_message2.template
+
+
+def test_no_bytecode_cache(tmp_path):
+    """Verify compiled templates aren't written to a shared directory."""
+    template_path = tmp_path/"template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        FROM: from@test.com
+
+        Hello world
+    """), encoding="utf8")
+    template_message = TemplateMessage(template_path)
+    assert template_message.template.environment.bytecode_cache is None
+
+
 def test_no_substitutions(tmp_path):
     """Render a template with an empty context."""
     template_path = tmp_path / "template.txt"
@@ -326,6 +355,34 @@ def test_markdown(tmp_path):
     assert html_docs_equal(htmltext_document, expected)
 
 
+def test_markdown_messages_independent(tmp_path):
+    """Markdown state from one message does not leak into the next."""
+    template_path = tmp_path / "template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        FROM: from@test.com
+        CONTENT-TYPE: text/markdown
+
+        See [the docs][docs].
+        {{definition}}
+    """), encoding="utf8")
+    template_message = TemplateMessage(template_path)
+
+    # First message defines the link reference
+    _, _, message = template_message.render({
+        "definition": "\n[docs]: http://example.com",
+    })
+    _, html_part = message.get_payload()[0].get_payload()
+    htmltext = html_part.get_payload(decode=True).decode("utf-8")
+    assert 'href="http://example.com"' in htmltext
+
+    # Second message doesn't, so there is no link
+    _, _, message = template_message.render({"definition": ""})
+    _, html_part = message.get_payload()[0].get_payload()
+    htmltext = html_part.get_payload(decode=True).decode("utf-8")
+    assert "href" not in htmltext
+
+
 def test_markdown_encoding(tmp_path):
     """Verify encoding is preserved when rendering a Markdown template.
 
@@ -463,6 +520,131 @@ def test_attachment_relative(tmpdir):
     assert content == b"Hello world\n"
 
 
+def test_attachment_relative_template_path(tmpdir):
+    """Attachments of a relative template path don't depend on the cwd."""
+    # Two template directories with the same template and attachment names
+    for dirname, content in [("one", "Hello one\n"), ("two", "Hello two\n")]:
+        Path(tmpdir/dirname).mkdir()
+        Path(tmpdir/dirname/"attachment.txt").write_text(
+            content, encoding="utf8",
+        )
+        Path(tmpdir/dirname/"template.txt").write_text(textwrap.dedent("""\
+            TO: to@test.com
+            FROM: from@test.com
+            ATTACHMENT: attachment.txt
+
+            Hello world
+        """), encoding="utf8")
+
+    # Render each template with a relative path from its own directory
+    for dirname, content in [("one", b"Hello one\n"), ("two", b"Hello two\n")]:
+        with tmpdir.join(dirname).as_cwd():
+            template_message = TemplateMessage(Path("template.txt"))
+            _, _, message = template_message.render({})
+        _, attachment_content, _ = extract_attachments(message)[0]
+        assert attachment_content == content
+
+
+def test_attachment_modified(tmp_path):
+    """Attachment modified between messages is read again."""
+    attachment_path = tmp_path/"attachment.txt"
+    attachment_path.write_text("Hello world\n", encoding="utf8")
+    template_path = tmp_path/"template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        FROM: from@test.com
+        ATTACHMENT: attachment.txt
+
+        Hello world
+    """), encoding="utf8")
+    template_message = TemplateMessage(template_path)
+
+    # First message
+    _, _, message = template_message.render({})
+    _, content, _ = extract_attachments(message)[0]
+    assert content == b"Hello world\n"
+
+    # Second message after modifying the attachment
+    attachment_path.write_text("Goodbye world\n", encoding="utf8")
+    _, _, message = template_message.render({})
+    _, content, _ = extract_attachments(message)[0]
+    assert content == b"Goodbye world\n"
+
+
+def test_attachment_removed(tmp_path):
+    """Verify an attachment removed after its first use is reported."""
+    attachment_path = tmp_path/"attachment.txt"
+    attachment_path.write_text("Hello world\n", encoding="utf8")
+    template_path = tmp_path/"template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        FROM: from@test.com
+        ATTACHMENT: attachment.txt
+
+        Hello world
+    """), encoding="utf8")
+    template_message = TemplateMessage(template_path)
+    template_message.render({})
+
+    # Remove the attachment and render another message
+    attachment_path.unlink()
+    with pytest.raises(MailmergeError) as err:
+        template_message.render({})
+    assert "Attachment not found" in str(err.value)
+
+
+def test_attachment_per_row_not_retained(mocker, tmp_path):
+    """Verify only the last file for each attachment header is kept."""
+    for name in ["one", "two"]:
+        (tmp_path/f"{name}.txt").write_text(f"{name}\n", encoding="utf8")
+    template_path = tmp_path/"template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        FROM: from@test.com
+        ATTACHMENT: {{name}}.txt
+
+        Hello world
+    """), encoding="utf8")
+    template_message = TemplateMessage(template_path)
+    read_attachment = mocker.spy(
+        mailmerge.template_message, "read_attachment_base64",
+    )
+
+    # The same attachment for consecutive messages is read once
+    template_message.render({"name": "one"})
+    template_message.render({"name": "one"})
+    assert read_attachment.call_count == 1
+
+    # A different attachment replaces it, so going back reads it again
+    template_message.render({"name": "two"})
+    template_message.render({"name": "one"})
+    assert read_attachment.call_count == 3
+
+
+def test_attachment_large(tmp_path):
+    """Attachment larger than one encoding chunk is encoded correctly."""
+    attachment_content = os.urandom(200 * 1024 + 1)
+    attachment_path = tmp_path/"attachment.bin"
+    attachment_path.write_bytes(attachment_content)
+    template_path = tmp_path/"template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        FROM: from@test.com
+        ATTACHMENT: attachment.bin
+
+        Hello world
+    """), encoding="utf8")
+    template_message = TemplateMessage(template_path)
+    _, _, message = template_message.render({})
+    _, content, _ = extract_attachments(message)[0]
+    assert content == attachment_content
+
+    # Encoded lines are all 76 characters, except the last one
+    attachment = message.get_payload()[1]
+    lines = attachment.get_payload().splitlines()
+    assert all(len(line) == 76 for line in lines[:-1])
+
+
 def test_attachment_absolute(tmpdir):
     """Attachment with absolute file path."""
     # Simple attachment lives in sub directory
@@ -778,6 +960,22 @@ def test_duplicate_headers_markdown(tmp_path):
     assert len(message.keys()) == len(set(message.keys()))
 
 
+def test_header_order_attachment(tmp_path):
+    """Verify multipart messages keep the template's header order."""
+    (tmp_path/"attachment.txt").write_text("Hello world\n", encoding="utf8")
+    template_path = tmp_path / "template.txt"
+    template_path.write_text(textwrap.dedent("""\
+        TO: to@test.com
+        X-Custom: one
+        FROM: from@test.com
+        X-Custom: two
+        ATTACHMENT: attachment.txt
+
+    """), encoding="utf8")
+    _, _, message = TemplateMessage(template_path).render({})
+    assert message.keys()[2:6] == ["TO", "X-Custom", "FROM", "X-Custom"]
+
+
 def test_attachment_image_in_markdown(tmp_path):
     """Images sent as attachments should get linked correctly in images."""
     shutil.copy(str(utils.TESTDATA/"attachment_3.jpg"), str(tmp_path))
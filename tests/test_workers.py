@@ -0,0 +1,178 @@
+"""
+Tests for concurrent sending with the --workers option.
+
+Andrew DeOrio <awdeorio@umich.edu>
+"""
+import textwrap
+import smtplib
+import time
+from pathlib import Path
+import click.testing
+from mailmerge.__main__ import main
+
+
+def test_workers(mocker, tmpdir):
+    """Verify --workers sends every message and prints them in order."""
+    # Simple template
+    template_path = Path(tmpdir/"mailmerge_template.txt")
+    template_path.write_text(textwrap.dedent("""\
+        TO: {{email}}
+        FROM: from@test.com
+
+        Hello world
+    """), encoding="utf8")
+
+    # Database with five entries
+    database_path = Path(tmpdir/"mailmerge_database.csv")
+    database_path.write_text(textwrap.dedent("""\
+        email
+        one@test.com
+        two@test.com
+        three@test.com
+        four@test.com
+        five@test.com
+    """), encoding="utf8")
+
+    # Simple unsecure server config
+    config_path = Path(tmpdir/"mailmerge_server.conf")
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """), encoding="utf8")
+
+    # Run mailmerge with mock SMTP
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    runner = click.testing.CliRunner()
+    with tmpdir.as_cwd():
+        result = runner.invoke(main, [
+            "--no-limit",
+            "--no-dry-run",
+            "--workers", "3",
+            "--output-format", "text",
+        ])
+    assert not result.exception
+    assert result.exit_code == 0
+
+    # Verify each message was sent once, and at most one connection was opened
+    # per worker
+    smtp = mock_smtp.return_value.__enter__.return_value
+    assert smtp.sendmail.call_count == 5
+    assert mock_smtp.call_count <= 3
+    recipients = sorted(c.args[1][0] for c in smtp.sendmail.call_args_list)
+    assert recipients == sorted([
+        "one@test.com", "two@test.com", "three@test.com",
+        "four@test.com", "five@test.com",
+    ])
+
+    # Verify output is in database order
+    positions = [
+        result.output.index(f">>> message {i} sent") for i in range(1, 6)
+    ]
+    assert positions == sorted(positions)
+
+
+def test_workers_error(mocker, tmpdir):
+    """Verify messages sent after an error are reported."""
+    template_path = Path(tmpdir/"mailmerge_template.txt")
+    template_path.write_text(textwrap.dedent("""\
+        TO: {{email}}
+        FROM: from@test.com
+
+        Hello world
+    """), encoding="utf8")
+    database_path = Path(tmpdir/"mailmerge_database.csv")
+    database_path.write_text(textwrap.dedent("""\
+        email
+        one@test.com
+        two@test.com
+        three@test.com
+        four@test.com
+        five@test.com
+    """), encoding="utf8")
+    config_path = Path(tmpdir/"mailmerge_server.conf")
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = open-smtp.example.com
+        port = 25
+    """), encoding="utf8")
+
+    # The server refuses the second message, slowly enough that the third and
+    # fourth messages finish sending first
+    def sendmail(sender, recipients, message):
+        # pylint: disable=unused-argument
+        if recipients == ["two@test.com"]:
+            time.sleep(0.2)
+            raise smtplib.SMTPDataError(550, "Mailbox unavailable")
+
+    # Run mailmerge with mock SMTP
+    mock_smtp = mocker.patch('smtplib.SMTP')
+    smtp = mock_smtp.return_value.__enter__.return_value
+    smtp.sendmail.side_effect = sendmail
+    runner = click.testing.CliRunner()
+    with tmpdir.as_cwd():
+        result = runner.invoke(main, [
+            "--no-limit",
+            "--no-dry-run",
+            "--workers", "3",
+            "--output-format", "text",
+        ])
+    assert result.exit_code == 1
+
+    # The fifth message was never started
+    recipients = sorted(c.args[1][0] for c in smtp.sendmail.call_args_list)
+    assert recipients == sorted([
+        "one@test.com", "two@test.com", "three@test.com", "four@test.com",
+    ])
+
+    # Messages sent after the error are printed and listed in the error
+    assert ">>> message 1 sent" in result.output
+    assert ">>> message 2 sent" not in result.output
+    assert ">>> message 3 sent" in result.output
+    assert ">>> message 4 sent" in result.output
+    assert "Error on message 2" in result.output
+    assert "Mailbox unavailable" in result.output
+    assert "Messages sent after the error: 3, 4" in result.output
+    assert 'Hint: "--resume 2"' in result.output
+
+
+def test_workers_dry_run_no_password(mocker, tmpdir):
+    """Verify a dry run with --workers doesn't prompt for a password."""
+    template_path = Path(tmpdir/"mailmerge_template.txt")
+    template_path.write_text(textwrap.dedent("""\
+        TO: {{email}}
+        FROM: from@test.com
+
+        Hello world
+    """), encoding="utf8")
+    database_path = Path(tmpdir/"mailmerge_database.csv")
+    database_path.write_text(textwrap.dedent("""\
+        email
+        one@test.com
+        two@test.com
+    """), encoding="utf8")
+    config_path = Path(tmpdir/"mailmerge_server.conf")
+    config_path.write_text(textwrap.dedent("""\
+        [smtp_server]
+        host = smtp.test.com
+        port = 465
+        security = SSL/TLS
+        username = YOUR_USERNAME_HERE
+    """), encoding="utf8")
+
+    # Run mailmerge with mock SMTP and getpass
+    mock_smtp_ssl = mocker.patch('smtplib.SMTP_SSL')
+    mock_getpass = mocker.patch('getpass.getpass')
+    runner = click.testing.CliRunner()
+    with tmpdir.as_cwd():
+        result = runner.invoke(main, [
+            "--no-limit",
+            "--dry-run",
+            "--workers", "2",
+            "--output-format", "text",
+        ])
+    assert not result.exception
+    assert result.exit_code == 0
+    assert mock_getpass.call_count == 0
+    assert mock_smtp_ssl.call_count == 0
+    assert ">>> message 2 sent" in result.output